@@ -14,8 +14,11 @@ class ElectionAdministration:
         Write election configuration to a shared file.
         """
         try:
-            with open(self.config_file, "w") as f:
-                json.dump(self.election_config, f, indent=4)
+            # Write to a temporary file and swap it in, so readers never see a partial file
+            tmp_file = f"{self.config_file}.tmp"
+            with open(tmp_file, "w") as f:
+                f.write(json.dumps(self.election_config, indent=4))
+            os.replace(tmp_file, self.config_file)
             print(f"✅ Election setup completed successfully!")
         except Exception as e:
             print(f"❌ Error during election setup: {e}")
@@ -1,24 +1,39 @@
+import asyncio
 import socket
 import threading
 import random
+import secrets
 import sys
 import json
+import os
+from protocol import BALLOT_TAG, send_msg, recv_msg, pack_msg, read_msg, decode_ballot
+
+_config_cache = {}  # (config_file, mtime) -> (candidates, total_voters)
 
 
 class CollectorServer:
-    def __init__(self, host, port, total_voters, is_collector1):
+    DRAIN_TIMEOUT = 30  # Seconds to wait for voters still mid-session once voting closes
+
+    def __init__(self, host, port, total_voters, is_collector1, candidates=None):
         self.host = host
         self.port = port
         self.total_voters = total_voters
         self.is_collector1 = is_collector1
-        self.received_ballots = []  # Store received secret ballots
-        self.random_shares = []  # Store random shares generated for voters
         self.lock = threading.Lock()  # Thread-safe access
-        self.secret_ballot_aggregate = [0, 0]  # Aggregate of secret ballots
-        self.random_share_aggregate = [0, 0]  # Aggregate of random shares
+        self.secret_ballot_aggregate = [0, 0]  # Running sum of received secret ballots
+        self.random_share_aggregate = [0, 0]  # Running sum of random shares given to voters
         self.peer_random_share_aggregate = [0, 0]  # Aggregate received from peer
-        self.stop_accepting = False  # Signal to stop accepting connections
-        self.candidates, _ = self.fetch_election_details()  # Fetch candidates dynamically
+        self.voter_connections = {}  # Handler task -> writer for voters currently being served
+        self.share_pool = self.draw_random_shares(2 * total_voters)  # Random shares for all voters
+        self.share_index = 0  # Next unused entry of share_pool
+        if candidates is None:
+            candidates, _ = self.fetch_election_details()  # Fetch candidates dynamically
+        self.candidates = candidates
+
+        # Each candidate's bit in every voter's group, one mask per candidate
+        candidate_count = len(self.candidates)
+        voter_bits = ((1 << (total_voters * candidate_count)) - 1) // ((1 << candidate_count) - 1)
+        self.candidate_masks = [voter_bits << c for c in range(candidate_count)]
 
         # Generate random shares for location shares
         self.location_shares = self.generate_unique_location_shares()
@@ -29,11 +44,14 @@ class CollectorServer:
         Fetch candidates and voter count from the election configuration file.
         """
         try:
-            with open(config_file, "r") as file:
-                config = json.load(file)
-                candidates = config["candidates"]
-                total_voters = config["total_voters"]
-                return candidates, total_voters
+            # Reuse the parsed configuration unless the file changed since it was read
+            key = (config_file, os.path.getmtime(config_file))
+            if key not in _config_cache:
+                with open(config_file, "r") as file:
+                    config = json.load(file)
+                    _config_cache[key] = (config["candidates"], config["total_voters"])
+            candidates, total_voters = _config_cache[key]
+            return candidates, total_voters
         except FileNotFoundError:
             print(f"Error: Configuration file '{config_file}' not found.")
             sys.exit(1)
@@ -41,13 +59,28 @@ class CollectorServer:
             print(f"Error: Missing key in configuration file: {e}")
             sys.exit(1)
 
+    @staticmethod
+    def draw_random_shares(count):
+        """
+        Draw `count` random shares between 1 and 10 from os.urandom in bulk.
+        Bytes of 250 and above are dropped so every share is equally likely.
+        """
+        shares = []
+        while len(shares) < count:
+            shares += [byte % 10 + 1 for byte in os.urandom(count - len(shares)) if byte < 250]
+        return shares
+
     def generate_random_shares(self):
         """
-        Generate two random shares for a voter.
+        Hand out the next two pre-generated random shares to a voter.
         """
-        random_share_1 = random.randint(1, 10)
-        random_share_2 = random.randint(1, 10)
-        self.random_shares.append((random_share_1, random_share_2))
+        with self.lock:
+            if self.share_index >= len(self.share_pool):  # More requests than voters
+                self.share_pool += self.draw_random_shares(2 * self.total_voters)
+            random_share_1, random_share_2 = self.share_pool[self.share_index:self.share_index + 2]
+            self.share_index += 2
+            self.random_share_aggregate[0] += random_share_1
+            self.random_share_aggregate[1] += random_share_2
         return random_share_1, random_share_2
 
     def generate_location_shares(self):
@@ -65,74 +98,80 @@ class CollectorServer:
         Generate unique random shares for all voters.
         Each voter gets a unique final location after combining shares.
         """
-        shares = []
-        while len(shares) < self.total_voters:
-            share = random.randint(-10 * self.total_voters, 10 * self.total_voters)  # Ensure a wide range
-            if share not in shares:
-                shares.append(share)
-        return shares
+        return tuple(secrets.SystemRandom().sample(range(-10 * self.total_voters, 10 * self.total_voters + 1), self.total_voters))  # Ensure a wide range
 
     def handle_voter(self, conn):
         """
         Handle communication with a voter or peer.
         """
         try:
-            data = conn.recv(1024).decode().strip()
-            if data.startswith("AGGREGATE"):  # Message from peer collector
-                self.handle_peer_message(data)
-            else:  # Voter message
-                self.handle_voter_message(data, conn)
+            # A voter keeps its connection open for the share request and the ballot
+            while True:
+                data = recv_msg(conn)
+                if data is None:  # Connection closed by the other side
+                    break
+                if data.startswith(b"AGGREGATE"):  # Message from peer collector
+                    self.handle_peer_message(data.decode().strip())
+                else:  # Voter message
+                    response = self.handle_voter_message(data)
+                    if response is not None:
+                        send_msg(conn, response.encode())
         except Exception as e:
             print(f"Error handling voter or peer: {e}")
         finally:
             conn.close()
 
+    async def handle_voter_stream(self, reader, writer):
+        """
+        Handle a voter connection on the event loop; an idle voter holds no thread.
+        """
+        task = asyncio.current_task()
+        self.voter_connections[task] = writer
+        try:
+            # A voter keeps its connection open for the share request and the ballot
+            while True:
+                data = await read_msg(reader)
+                if data is None:  # Connection closed by the voter
+                    break
+                response = self.handle_voter_message(data)
+                if response is not None:
+                    writer.write(pack_msg(response.encode()))
+                    await writer.drain()
+        except Exception as e:
+            print(f"Error handling voter: {e}")
+        finally:
+            del self.voter_connections[task]
+            writer.close()
+
     def tally_votes(self, final_result, candidates):
         """
         Tally votes from the final result based on binary representation and the candidate list.
         """
-        candidate_count = len(candidates)
-        voter_count = self.total_voters
-        binary_length = voter_count * candidate_count
-
         # Process each number in the final result
         for i, number in enumerate(final_result):
-            # Convert to binary, ensure it's the correct length
-            binary_representation = bin(number)[2:].zfill(binary_length)
-
-            # Reverse the binary string for the first number
-            if i == 0:
-                binary_representation = binary_representation[::-1]
-
-            # Split into groups of `candidate_count` bits
-            vote_splits = [binary_representation[j:j + candidate_count] for j in range(0, binary_length, candidate_count)]
-
-            # Tally votes dynamically
-            vote_counts = {candidate: 0 for candidate in candidates}
-            for split in vote_splits:
-                for idx, bit in enumerate(split):
-                    if bit == "1":
-                        vote_counts[candidates[idx]] += 1
+            # Count each candidate's set bits with a single popcount over the whole number
+            counts = [(number & mask).bit_count() for mask in self.candidate_masks]
+            vote_counts = dict(zip(candidates, counts))
 
             # Print results for this number
             print(f"Votes from Result {i + 1}: " + ", ".join(f"{candidate} = {vote_counts[candidate]}" for candidate in candidates))
     
-    def handle_voter_message(self, data, conn):
+    def handle_voter_message(self, data):
         """
-        Handle messages from voters.
+        Handle messages from voters and return the reply, or None on error.
         """
         try:
-            if "," in data:  # Received secret ballot
-                n1, n2 = map(int, data.split(","))
+            if data.startswith(BALLOT_TAG):  # Received secret ballot
+                n1, n2 = decode_ballot(data)
                 with self.lock:
-                    self.received_ballots.append((n1, n2))
+                    self.secret_ballot_aggregate[0] += n1
+                    self.secret_ballot_aggregate[1] += n2
                 print(f"Received Secret Ballot: n1 = {n1}, n2 = {n2}")
-                conn.send("ACK".encode())  # Acknowledge receipt
+                return "ACK"  # Acknowledge receipt
             else:  # Voter requesting random shares
-                voter_id = int(data)
-                # Get the partial location share for the voter
-                with self.lock:
-                    location_share = self.location_shares[voter_id - 1]  # Adjust for 0-based indexing
+                voter_id = int(data.decode())
+                # Get the partial location share for the voter; the tuple is never modified, so no lock
+                location_share = self.location_shares[voter_id - 1]  # Adjust for 0-based indexing
                 random_share_1, random_share_2 = self.generate_random_shares()
                 # Prepare the response
                 response = f"{location_share},{random_share_1},{random_share_2}"
@@ -142,9 +181,10 @@ class CollectorServer:
                 else:
                     print(f"Collector 2: Sent Location Share = {location_share}, Random Shares = {random_share_1}, {random_share_2} to Voter {voter_id}")
 
-                conn.send(response.encode())
+                return response
         except Exception as e:
             print(f"Error processing voter message: {e}")
+        return None
 
 
     def handle_peer_message(self, data):
@@ -157,9 +197,6 @@ class CollectorServer:
                 self.peer_random_share_aggregate = [int(peer_aggregate_1), int(peer_aggregate_2)]
                 print(f"Received Random Share Aggregate from Peer: {self.peer_random_share_aggregate}\n")
 
-                # Compute Collector's own aggregates
-                self.compute_aggregates()
-
                 # Perform the final calculation
                 result = [
                     self.secret_ballot_aggregate[0] - self.random_share_aggregate[0] - self.peer_random_share_aggregate[0],
@@ -179,46 +216,32 @@ class CollectorServer:
         except Exception as e:
             print(f"Error processing peer message: {e}")
 
-    def compute_aggregates(self):
-        with self.lock:
-            # Aggregate secret ballots
-            if self.received_ballots:
-                self.secret_ballot_aggregate = [
-                    sum(x) for x in zip(*self.received_ballots)
-                ]
-            else:
-                print("No Secret Ballots Received.")
-            # Aggregate random shares
-            if self.random_shares:
-                self.random_share_aggregate = [
-                    sum(x) for x in zip(*self.random_shares)
-                ]
-            else:
-                print("No Random Shares Generated.")
-
-
     def send_to_peer(self, peer_host, peer_port):
         """
         Send random share aggregate to the peer collector.
         """
         try:
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as peer_socket:
+                peer_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Send small messages immediately
                 peer_socket.connect((peer_host, peer_port))
                 aggregate_str = f"AGGREGATE,{self.random_share_aggregate[0]},{self.random_share_aggregate[1]}"
-                peer_socket.sendall(aggregate_str.encode())
+                send_msg(peer_socket, aggregate_str.encode())
         except Exception as e:
             print(f"Error sending data to Peer: {e}")
 
-    def accept_voter_connections(self, server):
+    async def stop_voter_server(self, server):
         """
-        Accept connections from voters until signaled to stop.
+        Stop accepting voters, then give voters still mid-session time to finish.
         """
-        while not self.stop_accepting:
-            try:
-                conn, addr = server.accept()
-                threading.Thread(target=self.handle_voter, args=(conn,)).start()
-            except OSError:
-                break  # Socket closed
+        server.close()
+        if self.voter_connections:
+            await asyncio.wait(list(self.voter_connections), timeout=self.DRAIN_TIMEOUT)
+        # Close abandoned connections; their handlers then see end of stream and exit
+        abandoned = list(self.voter_connections.items())
+        for _, writer in abandoned:
+            writer.close()
+        if abandoned:
+            await asyncio.wait([task for task, _ in abandoned])
 
     def accept_peer_connection(self, peer_port):
         """
@@ -235,33 +258,29 @@ class CollectorServer:
         """
         Start the collector server and coordinate the process.
         """
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
-            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            server.bind((self.host, self.port))
-            server.listen(5)
-            print(f"Collector Server started on {self.host}:{self.port} ({'Collector 1' if self.is_collector1 else 'Collector 2'})")
-
-            # Thread to accept voter connections
-            thread = threading.Thread(target=self.accept_voter_connections, args=(server,))
-            thread.start()
-
-            # Wait for all votes to be cast
-            input("🔔 Press Enter after all voters have cast their ballots...\n\n")
-            self.stop_accepting = True
-            server.close()  # Stop accepting connections
-            thread.join()
-
-            # Compute aggregates after receiving all voter ballots
-            self.compute_aggregates()
-
-            if self.is_collector1:
-                # Collector 1: Wait for aggregate from Collector 2, then send its aggregate back
-                self.accept_peer_connection(peer_receive_port)
-                self.send_to_peer(peer_host, peer_send_port)
-            else:
-                # Collector 2: Send aggregate to Collector 1, then wait for Collector 1's aggregate
-                self.send_to_peer(peer_host, peer_send_port)
-                self.accept_peer_connection(peer_receive_port)
+        # Serve voters from an event loop on a background thread, so a single thread
+        # handles every open voter connection
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(asyncio.start_server(self.handle_voter_stream, self.host, self.port, reuse_address=True))
+        print(f"Collector Server started on {self.host}:{self.port} ({'Collector 1' if self.is_collector1 else 'Collector 2'})")
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+
+        # Wait for all votes to be cast
+        input("🔔 Press Enter after all voters have cast their ballots...\n\n")
+        asyncio.run_coroutine_threadsafe(self.stop_voter_server(server), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+        if self.is_collector1:
+            # Collector 1: Wait for aggregate from Collector 2, then send its aggregate back
+            self.accept_peer_connection(peer_receive_port)
+            self.send_to_peer(peer_host, peer_send_port)
+        else:
+            # Collector 2: Send aggregate to Collector 1, then wait for Collector 1's aggregate
+            self.send_to_peer(peer_host, peer_send_port)
+            self.accept_peer_connection(peer_receive_port)
 
 
 if __name__ == "__main__":
@@ -279,5 +298,5 @@ if __name__ == "__main__":
     print(f"Election Details: \n 🗳️  Candidates = {candidates}, \n 👥 Total Voters = {TOTAL_VOTERS}")
 
 
-    collector = CollectorServer(HOST, PORT, TOTAL_VOTERS, IS_COLLECTOR1)
+    collector = CollectorServer(HOST, PORT, TOTAL_VOTERS, IS_COLLECTOR1, candidates=candidates)
     collector.start_server(PEER_HOST, PEER_SEND_PORT, PEER_RECEIVE_PORT)
@@ -0,0 +1,82 @@
+import asyncio
+import struct
+
+HEADER = struct.Struct("!I")  # Message length, 4 bytes in network byte order
+BALLOT_TAG = b"B"  # Leads a binary secret ballot; text messages never start with it
+
+
+def pack_msg(payload):
+    """
+    Prefix a message with its length.
+    """
+    return HEADER.pack(len(payload)) + payload
+
+
+def send_msg(sock, payload):
+    """
+    Send a message prefixed with its length.
+    """
+    sock.sendall(pack_msg(payload))
+
+
+def recv_exact(sock, size):
+    """
+    Read exactly `size` bytes; returns fewer only if the connection closes first.
+    """
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            break
+        buf += chunk
+    return bytes(buf)
+
+
+def recv_msg(sock):
+    """
+    Receive one length-prefixed message, or None once the connection is closed.
+    """
+    header = recv_exact(sock, HEADER.size)
+    if not header:
+        return None
+    if len(header) < HEADER.size:
+        raise ConnectionError("Connection closed in the middle of a message header")
+    (length,) = HEADER.unpack(header)
+    payload = recv_exact(sock, length)
+    if len(payload) < length:
+        raise ConnectionError("Connection closed in the middle of a message")
+    return payload
+
+
+async def read_msg(reader):
+    """
+    Counterpart of recv_msg for an asyncio StreamReader.
+    """
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ConnectionError("Connection closed in the middle of a message header")
+    (length,) = HEADER.unpack(header)
+    try:
+        return await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Connection closed in the middle of a message")
+
+
+def encode_ballot(n1, n2):
+    """
+    Pack a secret ballot as two equal-width big-endian integers after BALLOT_TAG.
+    """
+    nbytes = (max(n1, n2).bit_length() + 7) // 8
+    return BALLOT_TAG + n1.to_bytes(nbytes, "big") + n2.to_bytes(nbytes, "big")
+
+
+def decode_ballot(payload):
+    """
+    Unpack a secret ballot built by encode_ballot.
+    """
+    body = payload[len(BALLOT_TAG):]
+    half = len(body) // 2
+    return int.from_bytes(body[:half], "big"), int.from_bytes(body[half:], "big")
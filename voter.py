@@ -2,12 +2,15 @@ import socket
 import sys
 import json
 import os
-from threading import Lock
+import fcntl
+from contextlib import contextmanager
+from protocol import send_msg, recv_msg, encode_ballot
+
+_config_cache = {}  # (config_file, mtime) -> (candidates, total_voters)
 
 
 class VoterClient:
-    ASSIGNED_SHARES_FILE = "assigned_shares.json"
-    lock = Lock()  # Thread-safe access to the shared file
+    ASSIGNED_SHARES_FILE = "assigned_shares.txt"
 
     def __init__(self, voter_id, vote, total_voters, total_candidates, collectors):
         self.voter_id = voter_id
@@ -20,16 +23,21 @@ class VoterClient:
         self.random_shares_collector1 = []
         self.random_shares_collector2 = []
         self.secret_ballot = []
+        # One connection per collector, reused for the share request and the ballot
+        self.conns = [self.connect(collector) for collector in collectors]
 
     @staticmethod
     def fetch_election_details(config_file="election_config.json"):
         try:
-            with open(config_file, "r") as file:
-                config = json.load(file)
-                candidates = config["candidates"]
-                total_voters = config["total_voters"]
-                print(f"Election Details: \n 🗳️  Candidates = {candidates}, \n 👥 Total Voters = {total_voters}")
-                return candidates, total_voters
+            # Reuse the parsed configuration unless the file changed since it was read
+            key = (config_file, os.path.getmtime(config_file))
+            if key not in _config_cache:
+                with open(config_file, "r") as file:
+                    config = json.load(file)
+                    _config_cache[key] = (config["candidates"], config["total_voters"])
+            candidates, total_voters = _config_cache[key]
+            print(f"Election Details: \n 🗳️  Candidates = {candidates}, \n 👥 Total Voters = {total_voters}")
+            return candidates, total_voters
         except FileNotFoundError:
             print(f"Error: Configuration file '{config_file}' not found.")
             sys.exit(1)
@@ -37,76 +45,103 @@ class VoterClient:
             print(f"Error: Missing key in configuration file: {e}")
             sys.exit(1)
 
+    @staticmethod
+    @contextmanager
+    def assigned_shares_lock():
+        """
+        Hold an exclusive lock on the shared file; voters run as separate processes,
+        so the lock has to live in the file system rather than in memory.
+        """
+        with open(VoterClient.ASSIGNED_SHARES_FILE, "a") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
     @staticmethod
     def read_assigned_shares():
         """
-        Read the assigned shares from the shared file.
+        Read the assigned shares from the shared file as a set.
         """
         if not os.path.exists(VoterClient.ASSIGNED_SHARES_FILE):
-            return []
+            return set()
         with open(VoterClient.ASSIGNED_SHARES_FILE, "r") as file:
-            return json.load(file)
+            return {int(line) for line in file}
 
     @staticmethod
-    def write_assigned_shares(assigned_shares):
+    def write_assigned_shares(new_share):
         """
-        Write the updated assigned shares to the shared file.
+        Append a newly assigned share to the shared file, one share per line.
         """
-        with VoterClient.lock:
-            with open(VoterClient.ASSIGNED_SHARES_FILE, "w") as file:
-                json.dump(assigned_shares, file)
+        with open(VoterClient.ASSIGNED_SHARES_FILE, "a") as file:
+            file.write(f"{new_share}\n")
 
     @staticmethod
     def cleanup_assigned_shares(total_voters):
         """
         Delete the assigned shares file if all voters have been assigned their location shares.
         """
-        assigned_shares = VoterClient.read_assigned_shares()
-        if len(assigned_shares) == total_voters:
-            os.remove(VoterClient.ASSIGNED_SHARES_FILE)
+        with VoterClient.assigned_shares_lock():
+            assigned_shares = VoterClient.read_assigned_shares()
+            # An empty file was just recreated by taking the lock after another voter removed it
+            if len(assigned_shares) in (0, total_voters):
+                os.remove(VoterClient.ASSIGNED_SHARES_FILE)
 
 
-    def compute_voting_vector(self):
-        voting_vector = [0] * self.voting_vector_size
-        choice_index = self.vote
-        voting_vector[(self.location_share - 1) * self.total_candidates + choice_index] = 1
-        return voting_vector
+    def compute_numbers(self):
+        """
+        Compute the two ballot numbers, whose only set bit sits at the
+        voter's location slot plus the chosen candidate.
+        """
+        i = (self.location_share - 1) * self.total_candidates + self.vote
+        # Both numbers carry the same encoding; they only differ once
+        # the collectors' random shares are added
+        number1 = number2 = 1 << i
+        return number1, number2
 
-    def compute_numbers(self, voting_vector):
-        left_to_right = 0
-        right_to_left = 0
+    @staticmethod
+    def connect(collector):
+        """
+        Open a connection to a collector.
+        """
+        try:
+            conn = socket.create_connection(collector)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Send small messages immediately
+            return conn
+        except OSError as e:
+            print(f"Error connecting to Collector {collector}: {e}")
+            sys.exit(1)
 
-        for i, val in enumerate(voting_vector):
-            if val == 1:
-                left_to_right = 2 ** i
-                right_to_left = 2 ** (self.voting_vector_size - i - 1)
-                break
-        return left_to_right, right_to_left
+    def close_connections(self):
+        for conn in self.conns:
+            conn.close()
 
-    def receive_shares(self, collector, is_collector1):
+    def receive_shares(self, conn, is_collector1):
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
-                client.connect(collector)
-                client.sendall(str(self.voter_id).encode())  # Send voter ID
-                response = client.recv(1024).decode().strip()
-
-                # Parse the response
-                parts = response.split(",")
-                if len(parts) != 3:
-                    raise ValueError(f"Unexpected response format: {response}")
-
-                partial_location_share = int(parts[0])
-                random_share_1 = int(parts[1])
-                random_share_2 = int(parts[2])
-
-                if is_collector1:
-                    self.random_shares_collector1 = [random_share_1, random_share_2]
-                    print(f"Collector 1: Partial Location Share = {partial_location_share}, Random Shares = {random_share_1}, {random_share_2}")
-                else:
-                    self.random_shares_collector2 = [random_share_1, random_share_2]
-                    print(f"Collector 2: Partial Location Share = {partial_location_share}, Random Shares = {random_share_1}, {random_share_2}")
-
-                return partial_location_share
+            send_msg(conn, str(self.voter_id).encode())  # Send voter ID
+            response = recv_msg(conn)
+            if response is None:
+                raise ConnectionError("Collector closed the connection")
+            response = response.decode().strip()
+
+            # Parse the response
+            parts = response.split(",")
+            if len(parts) != 3:
+                raise ValueError(f"Unexpected response format: {response}")
+
+            partial_location_share = int(parts[0])
+            random_share_1 = int(parts[1])
+            random_share_2 = int(parts[2])
+
+            if is_collector1:
+                self.random_shares_collector1 = [random_share_1, random_share_2]
+                print(f"Collector 1: Partial Location Share = {partial_location_share}, Random Shares = {random_share_1}, {random_share_2}")
+            else:
+                self.random_shares_collector2 = [random_share_1, random_share_2]
+                print(f"Collector 2: Partial Location Share = {partial_location_share}, Random Shares = {random_share_1}, {random_share_2}")
+
+            return partial_location_share
         except Exception as e:
             print(f"Error receiving partial location shares: {e}")
             sys.exit(1)
@@ -114,35 +149,31 @@ class VoterClient:
     def vote_process(self):
         """
         Execute the voting process while ensuring unique location shares for each voter.
-        :param assigned_shares: List of already assigned location shares.
         """
-        location_share1 = self.receive_shares(self.collectors[0], True)  # From Collector 1
-        location_share2 = self.receive_shares(self.collectors[1], False)  # From Collector 2
+        location_share1 = self.receive_shares(self.conns[0], True)  # From Collector 1
+        location_share2 = self.receive_shares(self.conns[1], False)  # From Collector 2
 
         # Compute the initial location share
         computed_share = (location_share1 + location_share2) % self.total_voters
         if computed_share == 0:
             computed_share = self.total_voters
-        # Ensure uniqueness of the location share
-        assigned_shares = self.read_assigned_shares()
-        while computed_share in assigned_shares:
-            computed_share = (computed_share + 1) % self.total_voters
-            if computed_share == 0:
-                computed_share = self.total_voters
-
-        # Assign the unique location share
-        self.location_share = computed_share
-        assigned_shares.append(self.location_share)  # Update the shared list
-        self.write_assigned_shares(assigned_shares)
+        # Ensure uniqueness of the location share; the lock spans read, probe and append
+        # so two voters can never claim the same free slot
+        with self.assigned_shares_lock():
+            assigned_shares = self.read_assigned_shares()
+            while computed_share in assigned_shares:
+                computed_share = (computed_share + 1) % self.total_voters
+                if computed_share == 0:
+                    computed_share = self.total_voters
+
+            # Assign the unique location share
+            self.location_share = computed_share
+            self.write_assigned_shares(self.location_share)  # Update the shared file
         print(f"Voter {self.voter_id}: Unique Location Share = {self.location_share}")
 
-        # Compute voting vector
-        voting_vector = self.compute_voting_vector()
-        print(f"Voter {self.voter_id}: Voting Vector = {voting_vector}")
-
-        # Compute numbers from the voting vector
-        number1, number2 = self.compute_numbers(voting_vector)
-        print(f"Voter {self.voter_id}: Numbers from Voting Vector = [{number1}, {number2}]")
+        # Compute the ballot numbers for the chosen candidate at this location
+        number1, number2 = self.compute_numbers()
+        print(f"Voter {self.voter_id}: Ballot Numbers = [{number1}, {number2}]")
 
         # Compute secret ballot
         secret_number1 = number1 + self.random_shares_collector1[0] + self.random_shares_collector2[0]
@@ -152,19 +183,18 @@ class VoterClient:
 
         # Send secret ballot to collectors
         self.send_secret_ballot()
+        self.close_connections()
 
-        # Cleanup assigned_shares.json if all voters are assigned
+        # Cleanup assigned_shares.txt if all voters are assigned
         self.cleanup_assigned_shares(self.total_voters)
 
 
     def send_secret_ballot(self):
-        for collector in self.collectors:
+        ballot = encode_ballot(*self.secret_ballot)
+        for collector, conn in zip(self.collectors, self.conns):
             try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
-                    client.connect(collector)
-                    ballot_str = f"{self.secret_ballot[0]},{self.secret_ballot[1]}"
-                    client.sendall(ballot_str.encode())
-                    response = client.recv(1024).decode()
+                send_msg(conn, ballot)
+                response = recv_msg(conn)
             except Exception as e:
                 print(f"Error connecting to Collector {collector}: {e}")
 